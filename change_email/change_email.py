@@ -52,7 +52,7 @@
 #  - Odoo:
 #      - res.partner
 #  - Zendesk:
-#      - TBI
+#      - users: primary email identity (os.environ['ZENDESK_URL'])
 #  
 #  # History for "objects"
 #  =======================
@@ -87,6 +87,8 @@ import requests
 import boto3
 from botocore.client import Config
 from mailjet_rest import Client
+# Local imports
+from zendesk import ZendeskClient, ZENDESK_MAX_CALLS_PER_MIN, update_zendesk
 
 # Py2 and 3
 try:
@@ -454,6 +456,13 @@ def main(old_email, new_email):
                 log.info('Odoo: partner/contact updated.')
             else:
                 log.info('Skipping....')
+            #
+            if input(UPDATE_QUESTION % {'system': 'Zendesk'}).lower() == 'y' or cmd_args.auto:
+                if update_zendesk(old_email, new_email,
+                                  ZendeskClient(cmd_args.zendesk_max_calls_per_min)):
+                    log.info('Zendesk: user updated.')
+            else:
+                log.info('Skipping....')
         else:
             log.info('Exiting...')
 
@@ -465,6 +474,9 @@ if __name__ == '__main__':
     parser.add_argument('old_email', type=str, help='Old email')
     parser.add_argument('new_email', type=str, help='New email')
     parser.add_argument('--auto', action='store_true', help='No questions asked')
+    parser.add_argument('--zendesk-max-calls-per-min', dest='zendesk_max_calls_per_min',
+                        default=ZENDESK_MAX_CALLS_PER_MIN, type=int,
+                        help='How many Zendesk calls per minute.')
     #~ group = parser.add_mutually_exclusive_group()
     #~ group.add_argument('--id', dest='clang_id', type=int, help='Clang ID')
     #~ group.add_argument('--uuid', dest='uuid', type=str, help='UUID')
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fake_zendesk.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+###############################################################################
+#
+#  fake_zendesk.py
+#
+#  Local fake Zendesk server with the few endpoints zendesk.py uses:
+#
+#   - GET    /api/v2/users/search.json?query=email:"..." email:"..."
+#   - GET    /api/v2/users/show_many.json?ids=...&include=identities
+#   - GET    /api/v2/users/<id>/identities.json
+#   - PUT    /api/v2/users/<id>/identities/<id>.json
+#   - PUT    /api/v2/users/<id>/identities/<id>/make_primary.json
+#   - DELETE /api/v2/users/<id>/identities/<id>.json
+#
+#  The first request gets a 429, to exercise the retry.
+#
+#  Serve on localhost:8080 and point change_email.py or zendesk.py to it:
+#
+#       $ ./fake_zendesk.py
+#       $ export ZENDESK_URL='http://localhost:8080'
+#
+#  Or run the Zendesk step (single and batch) against it and check the result:
+#
+#       $ ./fake_zendesk.py --check
+#
+###############################################################################
+
+# System imports
+import os
+import re
+import json
+import argparse
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
+except ImportError as e:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+# Some constants
+USERS = [
+    (1, 'single@example.com'),
+    (2, 'batch1@example.com'),
+    (3, 'batch2@example.com'),
+    (4, 'taken@example.com'),
+    (5, 'double@example.com'),
+    (6, 'double@example.com'),
+]
+
+
+class FakeZendesk(object):
+    """In-memory users, identities and jobs."""
+
+    def __init__(self, users=USERS):
+        self.users      = dict()
+        self.identities = dict()
+        self.requests   = 0
+        self.throttle   = False     # Answer every request with a 429
+        self.next_id    = 100
+        for user_id, email in users:
+            self.users[user_id] = {'id': user_id, 'email': email}
+            self.identities[user_id] = [self.identity(user_id, email, True)]
+
+    def identity(self, user_id, email, primary=False):
+        self.next_id += 1
+        return {'id': self.next_id, 'user_id': user_id, 'type': 'email',
+                'value': email, 'primary': primary}
+
+    def email_taken(self, email, user_id):
+        return any(i['value'] == email for uid, ids in self.identities.items()
+                   for i in ids if uid != user_id)
+
+    def set_primary(self, user_id, identity_id):
+        for i in self.identities[user_id]:
+            i['primary'] = i['id'] == identity_id
+            if i['primary']:
+                self.users[user_id]['email'] = i['value']
+
+class Handler(BaseHTTPRequestHandler):
+    zendesk = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, data, code=200, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if data is not None:
+            self.wfile.write(json.dumps(data).encode())
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def throttled(self):
+        """Answer the very first request with a 429, or all of them when
+           throttling. The latter with an invalid Retry-After."""
+        self.zendesk.requests += 1
+        if self.zendesk.requests == 1:
+            self.send({'error': 'TooManyRequests'}, 429, {'Retry-After': '0.5'})
+            return True
+        if self.zendesk.throttle:
+            self.send({'error': 'TooManyRequests'}, 429, {'Retry-After': 'soon'})
+            return True
+        return False
+
+    def do_GET(self):
+        if self.throttled(): return
+        zd  = self.zendesk
+        url = urlparse(self.path)
+        m = re.match(r'^/api/v2/users/(\d+)/identities\.json$', url.path)
+        if url.path == '/api/v2/users/search.json':
+            query = parse_qs(url.query)['query'][0]
+            emails = [e.lower() for e in re.findall(r'email:"([^"]+)"', query)]
+            users = [u for u in zd.users.values() if any(
+                i['value'] in emails for i in zd.identities[u['id']])]
+            self.send({'users': users, 'count': len(users), 'next_page': None})
+        elif url.path == '/api/v2/users/show_many.json':
+            params = parse_qs(url.query)
+            ids = [int(i) for i in params['ids'][0].split(',')]
+            res = {'users': [zd.users[i] for i in ids if i in zd.users]}
+            if params.get('include') == ['identities']:
+                res['identities'] = [identity for i in ids
+                                     for identity in zd.identities.get(i, [])]
+            self.send(res)
+        elif m:
+            self.send({'identities': zd.identities[int(m.group(1))]})
+        else:
+            self.send({'error': 'InvalidEndpoint'}, 404)
+
+    def do_PUT(self):
+        if self.throttled(): return
+        zd   = self.zendesk
+        path = urlparse(self.path).path
+        m = re.match(r'^/api/v2/users/(\d+)/identities/(\d+)(/make_primary)?\.json$', path)
+        if m:
+            user_id, identity_id = int(m.group(1)), int(m.group(2))
+            identity = [i for i in zd.identities[user_id] if i['id'] == identity_id][0]
+            if m.group(3):
+                zd.set_primary(user_id, identity_id)
+                self.send({'identities': zd.identities[user_id]})
+                return
+            value = self.body()['identity']['value']
+            if zd.email_taken(value, user_id):
+                self.send({'error': 'RecordInvalid',
+                           'description': 'Value: %s is already being used '
+                                          'by another user' % value}, 422)
+                return
+            identity['value'] = value
+            if identity['primary']:
+                zd.users[user_id]['email'] = value
+            self.send({'identity': identity})
+        else:
+            self.send({'error': 'InvalidEndpoint'}, 404)
+
+    def do_DELETE(self):
+        if self.throttled(): return
+        zd = self.zendesk
+        m = re.match(r'^/api/v2/users/(\d+)/identities/(\d+)\.json$',
+                     urlparse(self.path).path)
+        if m:
+            user_id, identity_id = int(m.group(1)), int(m.group(2))
+            zd.identities[user_id] = [i for i in zd.identities[user_id]
+                                      if i['id'] != identity_id]
+            self.send(None, 204)
+        else:
+            self.send({'error': 'InvalidEndpoint'}, 404)
+
+
+def serve(port):
+    Handler.zendesk = FakeZendesk()
+    server = HTTPServer(('localhost', port), Handler)
+    return server
+
+def check():
+    """Run the Zendesk step, single and batch, against the fake server."""
+    server = serve(0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    os.environ['ZENDESK_URL']   = 'http://localhost:%s' % server.server_port
+    os.environ['ZENDESK_EMAIL'] = 'agent@example.com'
+    os.environ['ZENDESK_TOKEN'] = 'token'
+    import zendesk
+    zendesk.ZENDESK_RETRY_AFTER = 0
+    zd = zendesk.ZendeskClient(max_calls_per_min=6000)
+    fake = Handler.zendesk
+
+    assert zendesk.update_zendesk('single@example.com', 'single.new@example.com', zd)
+    assert fake.identities[1] == [dict(fake.identities[1][0],
+                                       value='single.new@example.com', primary=True)]
+    assert not zendesk.update_zendesk('double@example.com', 'x@example.com', zd)
+    assert not zendesk.update_zendesk('batch1@example.com', 'taken@example.com', zd)
+
+    # One search, one show_many and one PUT per user found
+    requests_before = fake.requests
+    summary = zendesk.update_zendesk_many([
+        ('batch1@example.com', 'batch1.new@example.com'),
+        ('batch2@example.com', 'taken@example.com'),
+        ('unknown@example.com', 'y@example.com'),
+        ('double@example.com', 'z@example.com'),
+    ], zd)
+    assert summary == {'updated': 1, 'not_found': 2, 'failed': 1}, summary
+    assert fake.requests - requests_before == 4, fake.requests - requests_before
+    assert [(i['value'], i['primary']) for i in fake.identities[2]] == \
+           [('batch1.new@example.com', True)], fake.identities[2]
+    assert fake.users[2]['email'] == 'batch1.new@example.com'
+    assert [i['value'] for i in fake.identities[3]] == ['batch2@example.com']
+
+    # Give up after ZENDESK_MAX_RETRIES 429's
+    fake.throttle = True
+    assert not zendesk.update_zendesk('batch2@example.com', 'b@example.com', zd)
+    assert zendesk.update_zendesk_many([('batch2@example.com', 'b@example.com')], zd) == \
+           {'updated': 0, 'not_found': 0, 'failed': 1}
+    server.shutdown()
+    print('OK')
+
+
+if __name__ == '__main__':
+    # Parse the command line
+    parser = argparse.ArgumentParser(description="""Local fake Zendesk
+        server to test the Zendesk step of change_email.py.""")
+    parser.add_argument('-p', '--port', dest='port', default=8080, type=int,
+                        help='Port to serve on.')
+    parser.add_argument('--check', action='store_true',
+                        help='Run the Zendesk step against it and check the result.')
+    cmd_args = parser.parse_args()
+    if cmd_args.check:
+        check()
+    else:
+        server = serve(cmd_args.port)
+        print('Fake Zendesk on http://localhost:%s' % cmd_args.port)
+        server.serve_forever()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  zendesk.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+###############################################################################
+#
+#  zendesk.py
+#
+#  Zendesk step of change_email.py: change the primary email identity of
+#  one user. Run on its own to change many users from a CSV-file:
+#
+#       $ ./zendesk.py --batch emails.csv
+#
+#  Zendesk's update_many job can't do this: on update, a user's 'email'
+#  is added as a secondary identity, leaving the old one primary. So the
+#  lookups are batched (a search for many emails, show_many with the
+#  identities sideloaded) and only the identity itself is changed per user.
+#
+#  Keys need to be in the environment:
+#
+#       ZENDESK_URL, ZENDESK_EMAIL, ZENDESK_TOKEN
+#
+#  Point ZENDESK_URL to fake_zendesk.py to test locally.
+#
+###############################################################################
+
+# System imports
+import os
+import csv
+import time
+import logging
+import argparse
+
+# Third party imports
+import requests
+
+# Py2 and 3
+try:
+   input = raw_input
+except NameError:
+   pass
+
+# Get logger
+log = logging.getLogger('change_email.zendesk')
+log.setLevel(logging.DEBUG)
+# create console handler and set level to debug
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+# create formatter
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+# add formatter to ch
+ch.setFormatter(formatter)
+# add ch to logger
+log.addHandler(ch)
+
+# Some constants
+ZENDESK_BATCH_SIZE  = 100   # Hard upper limit on the users in one show_many call
+ZENDESK_SEARCH_SIZE = 20    # Emails in one search query
+ZENDESK_MAX_RETRIES = 5     # Give up after this many 429's in a row
+ZENDESK_RETRY_AFTER = 60    # Seconds to wait after a 429 without (valid) Retry-After
+ZENDESK_MAX_CALLS_PER_MIN = 200
+BATCH_QUESTION = """Update %(count)s users in Zendesk? (y)es / (n)o : """
+
+class ZendeskClient(object):
+    """Minimal Zendesk API client: token auth, throttled to max_calls_per_min
+       and retrying on 429 after the 'Retry-After' the server asks for, at
+       most ZENDESK_MAX_RETRIES times.
+       Other HTTP errors raise a requests.exceptions.HTTPError."""
+
+    def __init__(self, max_calls_per_min=ZENDESK_MAX_CALLS_PER_MIN):
+        self.url        = os.environ['ZENDESK_URL'].rstrip('/')
+        self.session    = requests.Session()
+        self.session.auth = ('%s/token' % os.environ['ZENDESK_EMAIL'],
+                             os.environ['ZENDESK_TOKEN'])
+        self.interval   = 60 / float(max_calls_per_min)
+        self.last_call  = 0
+
+    def request(self, method, path, **kwargs):
+        url = path if path.startswith('http') else self.url + path
+        retries = 0
+        while True:
+            wait = self.last_call + self.interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_call = time.time()
+            r = self.session.request(method, url, **kwargs)
+            if r.status_code != 429 or retries >= ZENDESK_MAX_RETRIES:
+                break
+            retries += 1
+            try:
+                retry_after = float(r.headers['Retry-After'])
+            except (KeyError, ValueError) as e:
+                retry_after = ZENDESK_RETRY_AFTER
+            log.warn('Zendesk rate limit hit. Retrying after %s secs.', retry_after)
+            time.sleep(retry_after)
+        r.raise_for_status()
+        if r.status_code == 204:
+            return None
+        return r.json()
+
+def zendesk_get_many(zd, emails):
+    """Look up many emails with one search per ZENDESK_SEARCH_SIZE emails.
+       Return {email: user} for the emails of exactly one user."""
+    found = dict()
+    for i in range(0, len(emails), ZENDESK_SEARCH_SIZE):
+        chunk = emails[i:i + ZENDESK_SEARCH_SIZE]
+        query = ' '.join('email:"%s"' % email for email in chunk)
+        res = zd.request('GET', '/api/v2/users/search.json',
+                         params={'query': query})
+        users = res['users']
+        while res.get('next_page'):
+            res = zd.request('GET', res['next_page'])
+            users.extend(res['users'])
+        for email in chunk:
+            matches = [u for u in users if (u['email'] or '').lower() == email]
+            if len(matches) > 1:
+                log.warn('More then one user in Zendesk with email "%s". What to do?', email)
+            elif matches:
+                found[email] = matches[0]
+    return found
+
+def zendesk_get(zd, email):
+    """Get the Zendesk user with exactly this email or None.
+       None as well when there is more than one."""
+    return zendesk_get_many(zd, [email]).get(email)
+
+def zendesk_get_identities(zd, user_ids):
+    """Get the identities of many users with show_many, max
+       ZENDESK_BATCH_SIZE users per call. Return {user_id: [identity, ...]}"""
+    identities = dict((user_id, list()) for user_id in user_ids)
+    for i in range(0, len(user_ids), ZENDESK_BATCH_SIZE):
+        ids = ','.join(str(user_id) for user_id in user_ids[i:i + ZENDESK_BATCH_SIZE])
+        res = zd.request('GET', '/api/v2/users/show_many.json',
+                         params={'ids': ids, 'include': 'identities'})
+        for identity in res.get('identities', []):
+            identities.setdefault(identity['user_id'], []).append(identity)
+    return identities
+
+def zendesk_replace_identity(zd, user_id, identities, old_email, new_email):
+    """Make new_email the primary email identity of the user, in place of
+       old_email. Change the value of the old identity, or when the new one
+       is already there, make that one primary and delete the old one.
+       Return True if the old identity was found."""
+    path = '/api/v2/users/%s/identities' % user_id
+    emails = dict((i['value'].lower(), i) for i in identities
+                  if i['type'] == 'email')
+    old_identity = emails.get(old_email)
+    new_identity = emails.get(new_email)
+    if not old_identity:
+        log.warn('Zendesk user %s has no email identity "%s".', user_id, old_email)
+        return False
+    if new_identity:
+        if not new_identity['primary']:
+            zd.request('PUT', '%s/%s/make_primary.json' % (path, new_identity['id']))
+        zd.request('DELETE', '%s/%s.json' % (path, old_identity['id']))
+    else:
+        res = zd.request('PUT', '%s/%s.json' % (path, old_identity['id']),
+                         json={'identity': {'value': new_email}})
+        log.debug(res)
+        if not old_identity['primary']:
+            zd.request('PUT', '%s/%s/make_primary.json' % (path, old_identity['id']))
+    return True
+
+def update_zendesk(old_email, new_email, zd=None):
+    """Change the primary email identity of the Zendesk user."""
+    zd = zd or ZendeskClient()
+    try:
+        user = zendesk_get(zd, old_email)
+        if not user:
+            log.info('No (single) user found in Zendesk with email "%s".', old_email)
+            return False
+        log.info('Updating Zendesk user "%s" with ID: %s.', old_email, user['id'])
+        res = zd.request('GET', '/api/v2/users/%s/identities.json' % user['id'])
+        return zendesk_replace_identity(zd, user['id'], res['identities'],
+                                        old_email, new_email)
+    except requests.exceptions.HTTPError as e:
+        log.error('Zendesk: %s (%s)', e, e.response.text)
+        return False
+
+def update_zendesk_many(email_pairs, zd=None):
+    """Change the primary email identity of many Zendesk users. The users
+       and their identities are looked up in batches, after which only the
+       identity is changed per user.
+       email_pairs: [(old_email, new_email), ...]
+       Return a summary: {'updated': n, 'not_found': n, 'failed': n}"""
+    zd = zd or ZendeskClient()
+    summary = {'updated': 0, 'not_found': 0, 'failed': 0}
+    try:
+        users = zendesk_get_many(zd, [old_email for old_email, _ in email_pairs])
+        identities = zendesk_get_identities(zd, [u['id'] for u in users.values()])
+    except requests.exceptions.HTTPError as e:
+        log.error('Zendesk: looking up users: %s (%s)', e, e.response.text)
+        summary['failed'] = len(email_pairs)
+        return summary
+    for old_email, new_email in email_pairs:
+        user = users.get(old_email)
+        if not user:
+            log.info('No (single) user found in Zendesk with email "%s".', old_email)
+            summary['not_found'] += 1
+            continue
+        log.info('Updating Zendesk user "%s" with ID: %s.', old_email, user['id'])
+        try:
+            ok = zendesk_replace_identity(zd, user['id'], identities[user['id']],
+                                          old_email, new_email)
+        except requests.exceptions.HTTPError as e:
+            log.error('Zendesk: user %s: %s (%s)', user['id'], e, e.response.text)
+            ok = False
+        summary['updated' if ok else 'failed'] += 1
+    return summary
+
+def read_email_pairs(filename):
+    """Read (old_email, new_email) pairs from a 2-column CSV-file.
+       A header line is skipped, as are lines without two emailaddresses."""
+    pairs = list()
+    with open(filename) as f:
+        for line_num, row in enumerate(csv.reader(f), 1):
+            cells = [c.strip().lower() for c in row[:2]] + ['', '']
+            old_email, new_email = cells[:2]
+            if not old_email and not new_email:
+                continue
+            if line_num == 1 and '@' not in old_email:
+                continue
+            if '@' not in old_email or '@' not in new_email:
+                log.warn('Skipping line %s of "%s": %s', line_num, filename, row)
+                continue
+            pairs.append((old_email, new_email))
+    return pairs
+
+
+if __name__ == '__main__':
+    # Parse the command line
+    parser = argparse.ArgumentParser(description="""Change the emailaddress
+        of many Zendesk users.""")
+    parser.add_argument('--batch', dest='batch', type=str, required=True,
+                        help='CSV-file with old_email,new_email pairs.')
+    parser.add_argument('--auto', action='store_true', help='No questions asked')
+    parser.add_argument('--zendesk-max-calls-per-min', dest='zendesk_max_calls_per_min',
+                        default=ZENDESK_MAX_CALLS_PER_MIN, type=int,
+                        help='How many Zendesk calls per minute.')
+    cmd_args = parser.parse_args()
+    log.info('Start')
+    email_pairs = read_email_pairs(cmd_args.batch)
+    for old_email, new_email in email_pairs:
+        log.info('"%s" -> "%s"', old_email, new_email)
+    if cmd_args.auto or input(BATCH_QUESTION % {'count': len(email_pairs)}).lower() == 'y':
+        summary = update_zendesk_many(email_pairs,
+                                      ZendeskClient(cmd_args.zendesk_max_calls_per_min))
+        log.info('Zendesk: %(updated)s updated, %(not_found)s not found, '
+                 '%(failed)s failed.', summary)
+    else:
+        log.info('Skipping....')
+    log.info('Finished')
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
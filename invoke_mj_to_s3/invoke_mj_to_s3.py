@@ -47,9 +47,11 @@ import time
 import argparse
 import random
 from base64 import b64decode
+from collections import deque
 # Third party imports
 import boto3
 from botocore.client import Config
+from botocore.exceptions import BotoCoreError, ClientError
 # Import Mailjet client when we can get a count on a resource
 from mailjet_rest import Client
 from mailjet_rest.client import ApiError
@@ -77,6 +79,27 @@ log.addHandler(ch)
 # Some vars
 fn_arn      = os.environ['FN_ARN']
 MAX_LIMIT   = 1000 # Hard upper limit on the amount of resources fetchable in one call
+METRICS_PREFIX = 'invoke_mj_to_s3'
+# (name, Prometheus type, help) of the metrics in a status snapshot
+METRICS = [
+    ('shards_planned',              'gauge',   'Number of shards (λ invocations) for this run.'),
+    ('shards_dispatched',           'counter', 'Shards dispatched.'),
+    ('shards_succeeded',            'counter', 'Shards accepted by Lambda (StatusCode 202).'),
+    ('shards_failed',               'counter', 'Shards that failed to be invoked.'),
+    ('elapsed_seconds',             'gauge',   'Seconds since the start of the run.'),
+    ('calls_per_min',               'gauge',   'Calls made in the last 60 seconds.'),
+    ('calls_per_min_avg',           'gauge',   'Average calls per minute over the whole run (after the first minute).'),
+    ('max_calls_per_min',           'gauge',   'Configured MaxCallsPerMin.'),
+    ('rate_budget_left',            'gauge',   'Calls left before reaching MaxCallsPerMin in the last 60 seconds.'),
+    ('invoke_latency_seconds_avg',  'gauge',   'Average Lambda invoke latency in seconds.'),
+    ('invoke_latency_seconds_max',  'gauge',   'Maximum Lambda invoke latency in seconds.'),
+    ('invoke_latency_seconds_last', 'gauge',   'Last Lambda invoke latency in seconds.'),
+    ('eta_seconds',                 'gauge',   'Estimated seconds until all shards are dispatched.'),
+]
+MAX_CONSECUTIVE_FAILURES = 10  # Abort the run after this many failed invocations in a row
+# ClientError codes we can carry on after, all others abort the run
+THROTTLING_ERRORS = ('TooManyRequestsException', 'ThrottlingException',
+                     'Throttling', 'RequestLimitExceeded')
 
 # Lambda Boto3 Client
 lambda_client = boto3.client('lambda', region_name='eu-central-1')
@@ -134,6 +157,110 @@ def invoke_mj_to_s3(payload):
     return response
 
 
+class Metrics(object):
+    """Keep track of the progress and throughput of a run and periodically
+       write a compact snapshot of it, as JSON or in the Prometheus
+       textfile format (for the node_exporter textfile collector)."""
+
+    def __init__(self, payload, total_shards, path=None, fmt='json', interval=30):
+        self.resource       = payload['Resource']
+        self.max_calls      = payload['MaxCallsPerMin']
+        self.total_shards   = total_shards
+        self.path           = path
+        self.fmt            = fmt
+        self.interval       = interval
+        self.dispatched     = 0
+        self.succeeded      = 0
+        self.failed         = 0
+        self.invoked        = 0         # Real invocations, DryRun shards excluded
+        self.latency_sum    = 0.0
+        self.latency_max    = 0.0
+        self.latency_last   = 0.0
+        self.window         = deque()   # Timestamps of the calls in the last minute
+        self.start          = time.time()
+        self.last_write     = self.start
+
+    def record(self, ok, latency=None):
+        """Record a dispatched shard. Without latency (DryRun) it doesn't
+           count towards the latency metrics."""
+        now = time.time()
+        self.dispatched += 1
+        if ok:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        if latency is not None:
+            self.invoked += 1
+            self.latency_sum += latency
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+        self.window.append(now)
+
+    def snapshot(self):
+        now = time.time()
+        while self.window and self.window[0] <= now - 60:
+            self.window.popleft()
+        elapsed = now - self.start
+        # Averaging over less than a minute gives absurd rates
+        if elapsed >= 60:
+            calls_per_min_avg = self.dispatched / (elapsed / 60)
+        else:
+            calls_per_min_avg = len(self.window)
+        remaining = self.total_shards - self.dispatched
+        if self.dispatched:
+            eta = remaining * elapsed / self.dispatched
+        else:
+            eta = remaining * 60 / float(self.max_calls)
+        return {
+            'resource'                    : self.resource,
+            'shards_planned'              : self.total_shards,
+            'shards_dispatched'           : self.dispatched,
+            'shards_succeeded'            : self.succeeded,
+            'shards_failed'               : self.failed,
+            'elapsed_seconds'             : round(elapsed, 1),
+            'calls_per_min'               : len(self.window),
+            'calls_per_min_avg'           : round(calls_per_min_avg, 1),
+            'max_calls_per_min'           : self.max_calls,
+            'rate_budget_left'            : max(self.max_calls - len(self.window), 0),
+            'invoke_latency_seconds_avg'  : round(self.latency_sum / self.invoked, 3) if self.invoked else 0.0,
+            'invoke_latency_seconds_max'  : round(self.latency_max, 3),
+            'invoke_latency_seconds_last' : round(self.latency_last, 3),
+            'eta_seconds'                 : round(eta),
+        }
+
+    def to_prometheus(self, snap):
+        lines = []
+        for key, metric_type, help_text in METRICS:
+            name = '%s_%s' % (METRICS_PREFIX, key)
+            if metric_type == 'counter':
+                name += '_total'
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.append('%s{resource="%s"} %s' % (name, self.resource, snap[key]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, force=False):
+        """Log (and write to self.path) a snapshot, at most once every
+           self.interval seconds unless forced."""
+        now = time.time()
+        if not force and now - self.last_write < self.interval:
+            return
+        self.last_write = now
+        snap = self.snapshot()
+        log.info('Status: %s', json.dumps(snap, sort_keys=True))
+        if not self.path:
+            return
+        if self.fmt == 'prom':
+            content = self.to_prometheus(snap)
+        else:
+            content = json.dumps(snap, sort_keys=True) + '\n'
+        # Write to a temp file and rename, so readers never see a partial file
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, self.path)
+
+
 def lambda_handler(payload, cmd_args):
     auto = True
     total = get_total_number_in_resource(payload['Account'],
@@ -149,18 +276,52 @@ def lambda_handler(payload, cmd_args):
     if not cmd_args.auto:
         r = input('Continue? (y/n) ')
         if r != 'y': exit(0)
+    metrics = Metrics(payload, len(oa_tuples),
+                      path=cmd_args.metrics_file,
+                      fmt=cmd_args.metrics_format,
+                      interval=cmd_args.metrics_interval)
+    metrics.write(force=True)
+    try:
+        invoke_all(payload, oa_tuples, metrics)
+    finally:
+        metrics.write(force=True)
+
+def invoke_all(payload, oa_tuples, metrics):
+    """Invoke the λ-fn for every (offset, amount) tuple.
+       Throttling errors and network errors are counted and we carry on,
+       until MAX_CONSECUTIVE_FAILURES in a row. Any other ClientError
+       (bad credentials, missing function, ...) aborts the run."""
     i = 0
+    failures = 0
     for oa_tuple in oa_tuples:
         i += 1
         pl = make_fn_payload(payload, oa_tuple)
-        log.info('Iteration %s with payload: %s.', i, pl)
+        log.debug('Iteration %s with payload: %s.', i, pl)
         if not payload['DryRun']:
-            response = invoke_mj_to_s3(pl)
-            log.debug('StatusCode was: %s', response['StatusCode'])
+            start = time.time()
+            try:
+                response = invoke_mj_to_s3(pl)
+            except (BotoCoreError, ClientError) as e:
+                metrics.record(False, time.time() - start)
+                if isinstance(e, ClientError) and \
+                        e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                    raise
+                log.error('Iteration %s failed: %s', i, e)
+                ok = False
+            else:
+                log.debug('StatusCode was: %s', response['StatusCode'])
+                ok = response['StatusCode'] == 202
+                metrics.record(ok, time.time() - start)
+            failures = 0 if ok else failures + 1
+            if failures >= MAX_CONSECUTIVE_FAILURES:
+                log.error('%s invocations in a row failed. Aborting.', failures)
+                exit(1)
         else:
-            log.info('DryRun: no fn invoked. Iteration %s.', i)
+            log.debug('DryRun: no fn invoked. Iteration %s.', i)
+            metrics.record(True)
+        metrics.write()
         slptime = calculate_interval(payload['MaxCallsPerMin'], uniform_random=True)
-        log.info('Sleeping for %s secs...', slptime)
+        log.debug('Sleeping for %s secs...', slptime)
         time.sleep(slptime)
 
 
@@ -190,7 +351,19 @@ if __name__ == '__main__':
                         default=True, help='Randomize sleep interval.')
     parser.add_argument('-a', '--auto', dest='auto', action='store_true',
                         default=False, help='No questions asked.')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        default=False, help='Log every invocation.')
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                        help='Write a status snapshot to this file.')
+    parser.add_argument('--metrics-format', dest='metrics_format',
+                        choices=['json', 'prom'], default='json',
+                        help='Format of the metrics file: JSON or Prometheus textfile.')
+    parser.add_argument('--metrics-interval', dest='metrics_interval',
+                        default=30, type=int,
+                        help='Seconds between status snapshots.')
     cmd_args = parser.parse_args()
+    if not cmd_args.verbose:
+        ch.setLevel(logging.INFO)
     main(cmd_args)
 
 